@@ -1,9 +1,173 @@
-import random
 import json
+import os
+import sys
 import gym
 from gym import spaces
 import pandas as pd
 import numpy as np
+from numba import njit
+
+# Default configuration for callers that don't pass their own
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'AAPL.csv')
+MAX_ACCOUNT_BALANCE = 2147483647
+MAX_NUM_SHARES = 2147483647
+MAX_SHARE_PRICE = 5000
+MAX_OPEN_POSITION = 5
+MAX_STEPS = 20000
+INITIAL_ACCOUNT_BALANCE = 10000
+
+# Number of uniform draws made at once for the per-step price sampling
+_RNG_BUFFER_SIZE = 4096
+
+# Layout of the float64 account state array
+(_BALANCE,
+ _MAX_NET_WORTH,
+ _COST_BASIS,
+ _TOTAL_SALES_VALUE,
+ _NET_WORTH) = range(5)
+
+# Layout of the int64 share count array
+(_SHARES_HELD,
+ _TOTAL_SHARES_SOLD) = range(2)
+
+
+@njit(cache=True)
+def _apply(action_type, amount, price, balance, shares, cost_basis, max_net_worth, tss, tsv):
+    """Apply a single action to the account state and return the new state.
+
+    Buy and sell are selected with 0/1 masks rather than branches, since the
+    action type emitted by a stochastic policy is unpredictable.
+    """
+    buy = (action_type < 1) * 1.0
+    sell = ((action_type >= 1) & (action_type < 2)) * 1.0
+
+    # Buy amount % of balance in shares
+    shares_bought = int(buy * int(balance / price) * amount)
+    additional_cost = shares_bought * price
+    new_cost_basis = (cost_basis * shares + additional_cost) / max(shares + shares_bought, 1)
+
+    balance -= additional_cost
+    cost_basis = buy * new_cost_basis + (1 - buy) * cost_basis
+    shares += shares_bought
+
+    # Sell amount % of shares held
+    shares_sold = int(sell * shares * amount)
+    sales_value = shares_sold * price
+
+    balance += sales_value
+    shares -= shares_sold
+    tss += shares_sold
+    tsv += sales_value
+
+    net_worth = balance + shares * price
+    max_net_worth = max(max_net_worth, net_worth)
+    cost_basis *= (shares != 0) * 1.0
+
+    return balance, shares, cost_basis, net_worth, max_net_worth, tss, tsv
+
+
+@njit(cache=True)
+def _observe(ohlcv, step_idx, state, shares, obs_buf, inv_scale, norm_account):
+    """Write the scaled 6-day OHLCV window and account row into `obs_buf`."""
+    for i in range(5):
+        for j in range(6):
+            obs_buf[i, j] = ohlcv[step_idx + j, i] * inv_scale[i]
+
+    obs_buf[5, 0] = state[_BALANCE] * norm_account[0]
+    obs_buf[5, 1] = state[_MAX_NET_WORTH] * norm_account[1]
+    obs_buf[5, 2] = shares[_SHARES_HELD] * norm_account[2]
+    obs_buf[5, 3] = state[_COST_BASIS] * norm_account[3]
+    obs_buf[5, 4] = shares[_TOTAL_SHARES_SOLD] * norm_account[4]
+    obs_buf[5, 5] = state[_TOTAL_SALES_VALUE] * norm_account[5]
+
+
+@njit(cache=True)
+def _step_kernel(ohlcv, step_idx, max_start, state, shares, action_type, amount, u_buf, u_idx,
+                 obs_buf, inv_scale, norm_account, inv_max_steps):
+    """Run one environment step, updating `state`, `shares` and `obs_buf` in place.
+
+    Returns the reward, the done flag and the next step index.
+    """
+    # Set the current price to a random price within the time step; the
+    # float32 prices and uniform are widened so the price itself is float64
+    o = np.float64(ohlcv[step_idx, 0])
+    c = np.float64(ohlcv[step_idx, 3])
+    price = o + np.float64(u_buf[u_idx]) * (c - o)
+
+    balance, shares_held, cost_basis, net_worth, max_net_worth, tss, tsv = _apply(
+        action_type, amount, price,
+        state[_BALANCE], shares[_SHARES_HELD], state[_COST_BASIS],
+        state[_MAX_NET_WORTH], shares[_TOTAL_SHARES_SOLD], state[_TOTAL_SALES_VALUE])
+
+    state[_BALANCE] = balance
+    state[_MAX_NET_WORTH] = max_net_worth
+    state[_COST_BASIS] = cost_basis
+    state[_TOTAL_SALES_VALUE] = tsv
+    state[_NET_WORTH] = net_worth
+    shares[_SHARES_HELD] = shares_held
+    shares[_TOTAL_SHARES_SOLD] = tss
+
+    step_idx += 1
+
+    if step_idx > max_start:
+        step_idx = 0
+
+    reward = balance * (step_idx * inv_max_steps)
+
+    # End the episode on bankruptcy or when the data runs out
+    done = net_worth <= 0 or step_idx >= max_start
+
+    _observe(ohlcv, step_idx, state, shares, obs_buf, inv_scale, norm_account)
+
+    return reward, done, step_idx
+
+
+def cache_ohlcv(csv_path):
+    """Save the OHLCV columns of a CSV file as a `.npy` file next to it.
+
+    The conversion only runs when the `.npy` file is missing or older than
+    the CSV. Returns the path of the `.npy` file.
+    """
+    csv_path = os.fspath(csv_path)
+    npy_path = csv_path + '.npy'
+
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(csv_path):
+        ohlcv = load_ohlcv(pd.read_csv(csv_path, index_col=[0]))
+
+        # Write to a temporary file first so concurrent readers never map a partial file
+        tmp_path = f'{npy_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, ohlcv)
+        os.replace(tmp_path, npy_path)
+
+    return npy_path
+
+
+def load_ohlcv(data):
+    """Return the OHLCV price data in `data` as a C-contiguous float32 array.
+
+    `data` is usually a path: a `.npy` file is memory-mapped read-only, and a
+    `.csv` file is first converted with `cache_ohlcv`. Arrays already in the
+    right layout are passed through untouched, so several environments can
+    share one copy of the price data. DataFrames and Ray object references
+    are accepted as well.
+    """
+    if isinstance(data, (str, os.PathLike)):
+        path = os.fspath(data)
+        if path.endswith('.csv'):
+            path = cache_ohlcv(path)
+        data = np.load(path, mmap_mode='r')
+    # An object reference can only exist if Ray is already loaded, so the
+    # standalone environment never has to import it
+    ray = sys.modules.get('ray')
+    if ray is not None and isinstance(data, ray.ObjectRef):
+        data = ray.get(data)
+    if isinstance(data, pd.DataFrame):
+        # pandas hands back the column block transposed (Fortran order), which
+        # would make every row window a strided gather
+        data = data[['Open', 'High', 'Low', 'Close', 'Volume']].to_numpy(dtype=np.float32)
+
+    return np.ascontiguousarray(data, dtype=np.float32)
 
 
 class StockTradingEnvironment(gym.Env):
@@ -11,132 +175,167 @@ class StockTradingEnvironment(gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self,
-                df,
-                MAX_ACCOUNT_BALANCE,
-                MAX_NUM_SHARES,
-                MAX_SHARE_PRICE,
-                MAX_OPEN_POSITION,
-                MAX_STEPS,
-                INITIAL_ACCOUNT_BALANCE):
+                data=DATA_PATH,
+                MAX_ACCOUNT_BALANCE=MAX_ACCOUNT_BALANCE,
+                MAX_NUM_SHARES=MAX_NUM_SHARES,
+                MAX_SHARE_PRICE=MAX_SHARE_PRICE,
+                MAX_OPEN_POSITION=MAX_OPEN_POSITION,
+                MAX_STEPS=MAX_STEPS,
+                INITIAL_ACCOUNT_BALANCE=INITIAL_ACCOUNT_BALANCE,
+                steps_per_call=1):
         super(StockTradingEnvironment, self).__init__()
 
-        self.df = df
         self.MAX_ACCOUNT_BALANCE = MAX_ACCOUNT_BALANCE
         self.MAX_NUM_SHARES = MAX_NUM_SHARES
         self.MAX_SHARE_PRICE = MAX_SHARE_PRICE
         self.MAX_OPEN_POSITION = MAX_OPEN_POSITION
         self.MAX_STEPS = MAX_STEPS
         self.INITIAL_ACCOUNT_BALANCE = INITIAL_ACCOUNT_BALANCE
+        self.steps_per_call = steps_per_call
         self.reward_range = (0, MAX_ACCOUNT_BALANCE)
 
+        # OHLCV columns as one contiguous array, so the hot path never goes
+        # through pandas label indexing
+        self._ohlcv = load_ohlcv(data)
+        # Last step at which a full 6-day window still fits in the data
+        self._max_start = len(self._ohlcv) - 6
+        self._inv_scale = np.array(
+            [1 / MAX_SHARE_PRICE] * 4 + [1 / MAX_NUM_SHARES], dtype=np.float32)
+        self._inv_max_steps = 1 / MAX_STEPS
+        self._norm_account = np.array([
+            1 / MAX_ACCOUNT_BALANCE,
+            1 / MAX_ACCOUNT_BALANCE,
+            1 / MAX_NUM_SHARES,
+            1 / MAX_SHARE_PRICE,
+            1 / MAX_NUM_SHARES,
+            1 / (MAX_NUM_SHARES * MAX_SHARE_PRICE),
+        ], dtype=np.float32)
+        self._obs_buf = np.zeros((6, 6), dtype=np.float32, order='C')
+        self._state = np.zeros(5, dtype=np.float64)
+        self._shares = np.zeros(2, dtype=np.int64)
+
+        # Uniforms are drawn in blocks and consumed one per step by the kernel
+        self._rng = np.random.default_rng()
+        self._u = self._rng.random(_RNG_BUFFER_SIZE, dtype=np.float32)
+        self._u_idx = 0
+
         # Actions of the format Buy x%, Sell x%, Hold, etc.
         self.action_space = spaces.Box(
             low=np.array([0, 0]), high=np.array([3, 1]), dtype=np.float16)
 
-        # Prices contains the OHCL values for the last five prices
+        # Prices contains the OHCL values for the last five prices; built in
+        # float32 end to end, so no widening or narrowing on the hot path
         self.observation_space = spaces.Box(
-            low=0, high=1, shape=(6, 6), dtype=np.float16)
+            low=0, high=1, shape=(6, 6), dtype=np.float32)
     
     def reset(self):
         # Reset the state of the environment to an initial state
-        self.balance = self.INITIAL_ACCOUNT_BALANCE
-        self.net_worth = self.INITIAL_ACCOUNT_BALANCE
-        self.max_net_worth = self.INITIAL_ACCOUNT_BALANCE
-        self.shares_held = 0
-        self.cost_basis = 0
-        self.total_shares_sold = 0
-        self.total_sales_value = 0
-
-        # Set the current step to a random point within the data frame
-        self.current_step = random.randint(
-            0, len(self.df.loc[:, 'Open'].values) - 6)
+        self._state[:] = 0
+        self._state[_BALANCE] = self.INITIAL_ACCOUNT_BALANCE
+        self._state[_NET_WORTH] = self.INITIAL_ACCOUNT_BALANCE
+        self._state[_MAX_NET_WORTH] = self.INITIAL_ACCOUNT_BALANCE
+        self._shares[:] = 0
+
+        # Set the current step to a random point within the data frame; stop
+        # short of the last window so the time limit is reached before wrapping
+        self.current_step = int(self._rng.integers(0, self._max_start))
 
         return self._next_observation()
 
-    def _next_observation(self):
-        # Get the stock data points for the last 5 days and scale to between 0-1
-        frame = np.array([
-            self.df.loc[self.current_step: self.current_step +
-                        5, 'Open'].values / self.MAX_SHARE_PRICE,
-            self.df.loc[self.current_step: self.current_step +
-                        5, 'High'].values / self.MAX_SHARE_PRICE,
-            self.df.loc[self.current_step: self.current_step +
-                        5, 'Low'].values / self.MAX_SHARE_PRICE,
-            self.df.loc[self.current_step: self.current_step +
-                        5, 'Close'].values / self.MAX_SHARE_PRICE,
-            self.df.loc[self.current_step: self.current_step +
-                        5, 'Volume'].values / self.MAX_NUM_SHARES,
-        ])
-        
-        # Append additional data and scale each value to between 0-1
-        obs = np.append(frame, [[
-            self.balance / self.MAX_ACCOUNT_BALANCE,
-            self.max_net_worth / self.MAX_ACCOUNT_BALANCE,
-            self.shares_held / self.MAX_NUM_SHARES,
-            self.cost_basis / self.MAX_SHARE_PRICE,
-            self.total_shares_sold / self.MAX_NUM_SHARES,
-            self.total_sales_value / (self.MAX_NUM_SHARES * self.MAX_SHARE_PRICE),
-        ]], axis=0)
-
-        return obs
-
-    def _take_action(self, action):
-        # Set the current price to a random price within the time step
-        current_price = random.uniform(
-            self.df.loc[self.current_step, "Open"], self.df.loc[self.current_step, "Close"])
-
-        action_type = action[0]
-        amount = action[1]
-
-        if action_type < 1:
-            # Buy amount % of balance in shares
-            total_possible = int(self.balance / current_price)
-            shares_bought = int(total_possible * amount)
-            prev_cost = self.cost_basis * self.shares_held
-            additional_cost = shares_bought * current_price
-
-            self.balance -= additional_cost
-            self.cost_basis = (
-                prev_cost + additional_cost) / (self.shares_held + shares_bought)
-            self.shares_held += shares_bought
-
-        elif action_type < 2:
-            # Sell amount % of shares held
-            shares_sold = int(self.shares_held * amount)
-            self.balance += shares_sold * current_price
-            self.shares_held -= shares_sold
-            self.total_shares_sold += shares_sold
-            self.total_sales_value += shares_sold * current_price
-
-        self.net_worth = self.balance + self.shares_held * current_price
-
-        if self.net_worth > self.max_net_worth:
-            self.max_net_worth = self.net_worth
-
-        if self.shares_held == 0:
-            self.cost_basis = 0
+    @property
+    def balance(self):
+        return self._state[_BALANCE]
 
-    def step(self, action):
-        # Execute one time step within the environment
-        self._take_action(action)
+    @property
+    def net_worth(self):
+        return self._state[_NET_WORTH]
 
-        self.current_step += 1
+    @property
+    def max_net_worth(self):
+        return self._state[_MAX_NET_WORTH]
 
-        if self.current_step > len(self.df.loc[:, 'Open'].values) - 6:
-            self.current_step = 0
+    @property
+    def shares_held(self):
+        return int(self._shares[_SHARES_HELD])
 
-        delay_modifier = (self.current_step / self.MAX_STEPS)
-        
-        reward = self.balance * delay_modifier
+    @property
+    def cost_basis(self):
+        return self._state[_COST_BASIS]
 
-        if self.net_worth <= 0:
-            done = False
-        else:
-            done = True
+    @property
+    def total_shares_sold(self):
+        return int(self._shares[_TOTAL_SHARES_SOLD])
 
-        obs = self._next_observation()
-        
-        return obs, reward, done, {}
+    @property
+    def total_sales_value(self):
+        return self._state[_TOTAL_SALES_VALUE]
+
+    def _next_observation(self):
+        # Get the stock data points for the last 5 days plus the account data, scaled to between 0-1
+        _observe(self._ohlcv, self.current_step, self._state, self._shares,
+                 self._obs_buf, self._inv_scale, self._norm_account)
+
+        # RLlib keeps references to returned observations, so hand out a copy
+        return self._obs_buf.copy()
+
+    def _next_uniform(self):
+        # Index of the next buffered uniform, refilling the buffer when it runs out
+        if self._u_idx == len(self._u):
+            self._rng.random(dtype=np.float32, out=self._u)
+            self._u_idx = 0
+
+        self._u_idx += 1
+        return self._u_idx - 1
+
+    def step(self, action):
+        # Execute one time step within the environment
+        reward, done, self.current_step = _step_kernel(
+            self._ohlcv, self.current_step, self._max_start, self._state, self._shares,
+            float(action[0]), float(action[1]), self._u, self._next_uniform(),
+            self._obs_buf, self._inv_scale, self._norm_account, self._inv_max_steps)
+
+        # RLlib keeps references to returned observations, so hand out a copy
+        return self._obs_buf.copy(), reward, done, {}
+
+    def batch_step(self, actions):
+        """Execute up to `steps_per_call` steps in a single call.
+
+        Meant for driving the environment from a Ray actor, where each call is
+        a remote round trip. Stops early at the end of an episode and returns
+        the trajectory as stacked observations, rewards and dones plus one
+        info dict per step taken.
+        """
+        if len(actions) > self.steps_per_call:
+            raise ValueError(
+                f'Got {len(actions)} actions but steps_per_call is {self.steps_per_call}')
+
+        # Fresh arrays each call, since the caller keeps the returned trajectory
+        obs = np.zeros((len(actions), 6, 6), dtype=np.float32)
+        rewards = np.zeros(len(actions), dtype=np.float64)
+        dones = np.zeros(len(actions), dtype=bool)
+
+        count = 0
+        for action in actions:
+            reward, done, self.current_step = _step_kernel(
+                self._ohlcv, self.current_step, self._max_start, self._state, self._shares,
+                float(action[0]), float(action[1]), self._u, self._next_uniform(),
+                obs[count], self._inv_scale, self._norm_account, self._inv_max_steps)
+            rewards[count] = reward
+            dones[count] = done
+            count += 1
+
+            if done:
+                break
+
+        return obs[:count], rewards[:count], dones[:count], [{} for _ in range(count)]
+
+    def seed(self, seed=None):
+        # Re-seed the generator and discard uniforms drawn from the old one
+        self._rng = np.random.default_rng(seed)
+        self._rng.random(dtype=np.float32, out=self._u)
+        self._u_idx = 0
+
+        return [seed]
 
     def render(self, mode='human', close=False):
         # Render the environment to the screen
@@ -154,21 +353,13 @@ class StockTradingEnvironment(gym.Env):
 
 if __name__ == "__main__":
 
-    df = pd.read_csv("../data/AAPL.csv", index_col=[0])
-    MAX_ACCOUNT_BALANCE=2147483647
-    MAX_NUM_SHARES=2147483647
-    MAX_SHARE_PRICE=5000
-    MAX_OPEN_POSITION=5
-    MAX_STEPS=20000
-    INITIAL_ACCOUNT_BALANCE=10000
-
-    env = StockTradingEnvironment(df,
-                                  MAX_ACCOUNT_BALANCE, 
-                                  MAX_NUM_SHARES, 
-                                  MAX_SHARE_PRICE, 
-                                  MAX_OPEN_POSITION, 
-                                  MAX_STEPS, 
-                                  INITIAL_ACCOUNT_BALANCE)
+    # Run through the canonical `env.StockTradingEnvironment` module. Kernels
+    # defined under `__main__` would be a second copy of the same functions,
+    # and their Numba cache entries can't be shared with the trainer's
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from env.StockTradingEnvironment import StockTradingEnvironment
+
+    env = StockTradingEnvironment()
 
     env.reset()
 
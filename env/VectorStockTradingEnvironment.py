@@ -0,0 +1,224 @@
+from gym import spaces
+import numpy as np
+from ray.rllib.env.vector_env import VectorEnv
+
+from env.StockTradingEnvironment import (
+    DATA_PATH,
+    MAX_ACCOUNT_BALANCE,
+    MAX_NUM_SHARES,
+    MAX_SHARE_PRICE,
+    MAX_OPEN_POSITION,
+    MAX_STEPS,
+    INITIAL_ACCOUNT_BALANCE,
+    load_ohlcv,
+)
+
+
+class VectorStockTradingEnvironment(VectorEnv):
+    """A batch of stock trading environments stepped in a single call for RLlib
+
+    The sub-environments only exist as rows of shared state arrays, not as
+    separate env objects, so per-env access through get_unwrapped() (and
+    RLlib's foreach_env) is not supported.
+    """
+
+    def __init__(self,
+                data=DATA_PATH,
+                MAX_ACCOUNT_BALANCE=MAX_ACCOUNT_BALANCE,
+                MAX_NUM_SHARES=MAX_NUM_SHARES,
+                MAX_SHARE_PRICE=MAX_SHARE_PRICE,
+                MAX_OPEN_POSITION=MAX_OPEN_POSITION,
+                MAX_STEPS=MAX_STEPS,
+                INITIAL_ACCOUNT_BALANCE=INITIAL_ACCOUNT_BALANCE,
+                num_envs=1):
+
+        # Load the price data once and share it between all sub-environments
+        self._ohlcv = load_ohlcv(data)
+        # Last step at which a full 6-day window still fits in the data
+        self._max_start = len(self._ohlcv) - 6
+        self._offsets = np.arange(6)
+        self._inv_scale = np.array(
+            [1 / MAX_SHARE_PRICE] * 4 + [1 / MAX_NUM_SHARES], dtype=np.float32)
+        self._inv_max_steps = 1 / MAX_STEPS
+        self._norm_account = np.array([
+            1 / MAX_ACCOUNT_BALANCE,
+            1 / MAX_ACCOUNT_BALANCE,
+            1 / MAX_NUM_SHARES,
+            1 / MAX_SHARE_PRICE,
+            1 / MAX_NUM_SHARES,
+            1 / (MAX_NUM_SHARES * MAX_SHARE_PRICE),
+        ], dtype=np.float32)
+        self._obs_buf = np.zeros((num_envs, 6, 6), dtype=np.float32, order='C')
+        self._window_idx = np.empty((num_envs, 6), dtype=np.int64)
+        self._windows = np.empty((num_envs, 6, 5), dtype=np.float32)
+        self._rng = np.random.default_rng()
+
+        # Per-step scratch and output buffers, reused on every step
+        self._open = np.empty(num_envs, dtype=np.float32)
+        self._close = np.empty(num_envs, dtype=np.float32)
+        self._price = np.empty(num_envs, dtype=np.float64)
+        self._rewards = np.empty(num_envs, dtype=np.float64)
+        self._dones = np.empty(num_envs, dtype=bool)
+        self._buy = np.empty(num_envs, dtype=bool)
+        self._sell = np.empty(num_envs, dtype=bool)
+        self._mask = np.empty(num_envs, dtype=bool)
+        self._tmp = np.empty(num_envs, dtype=np.float64)
+        self._value = np.empty(num_envs, dtype=np.float64)
+        self._traded = np.empty(num_envs, dtype=np.int64)
+        self._count = np.empty(num_envs, dtype=np.int64)
+
+        self.MAX_ACCOUNT_BALANCE = MAX_ACCOUNT_BALANCE
+        self.MAX_NUM_SHARES = MAX_NUM_SHARES
+        self.MAX_SHARE_PRICE = MAX_SHARE_PRICE
+        self.MAX_OPEN_POSITION = MAX_OPEN_POSITION
+        self.MAX_STEPS = MAX_STEPS
+        self.INITIAL_ACCOUNT_BALANCE = INITIAL_ACCOUNT_BALANCE
+        self.reward_range = (0, MAX_ACCOUNT_BALANCE)
+
+        # Account state of every sub-environment, stored as one array per field
+        self.balance = np.full(num_envs, INITIAL_ACCOUNT_BALANCE, dtype=np.float64)
+        self.net_worth = np.full(num_envs, INITIAL_ACCOUNT_BALANCE, dtype=np.float64)
+        self.max_net_worth = np.full(num_envs, INITIAL_ACCOUNT_BALANCE, dtype=np.float64)
+        self.shares_held = np.zeros(num_envs, dtype=np.int64)
+        self.cost_basis = np.zeros(num_envs, dtype=np.float64)
+        self.total_shares_sold = np.zeros(num_envs, dtype=np.int64)
+        self.total_sales_value = np.zeros(num_envs, dtype=np.float64)
+        self.current_step = np.zeros(num_envs, dtype=np.int64)
+
+        # Same spaces as a single StockTradingEnvironment
+        action_space = spaces.Box(
+            low=np.array([0, 0]), high=np.array([3, 1]), dtype=np.float16)
+        observation_space = spaces.Box(
+            low=0, high=1, shape=(6, 6), dtype=np.float32)
+
+        super(VectorStockTradingEnvironment, self).__init__(
+            observation_space, action_space, num_envs)
+
+    def vector_reset(self):
+        # Reset every sub-environment and return the batch of observations
+        for index in range(self.num_envs):
+            self._reset_state(index)
+
+        return self._next_observation(slice(None))
+
+    def reset_at(self, index):
+        self._reset_state(index)
+
+        return self._next_observation(index)
+
+    def _reset_state(self, index):
+        # Reset the state of one sub-environment to an initial state
+        self.balance[index] = self.INITIAL_ACCOUNT_BALANCE
+        self.net_worth[index] = self.INITIAL_ACCOUNT_BALANCE
+        self.max_net_worth[index] = self.INITIAL_ACCOUNT_BALANCE
+        self.shares_held[index] = 0
+        self.cost_basis[index] = 0
+        self.total_shares_sold[index] = 0
+        self.total_sales_value[index] = 0
+
+        # Set the current step to a random point within the data frame; stop
+        # short of the last window so the time limit is reached before wrapping
+        self.current_step[index] = self._rng.integers(0, self._max_start)
+
+    def _next_observation(self, index):
+        # Write the 6-day window of every selected sub-environment, scaled to
+        # between 0-1, into its slot of the observation buffer
+        obs = self._obs_buf[index]
+        idx = self._window_idx[index]
+        np.add(self.current_step[index, None], self._offsets, out=idx)
+        windows = self._windows[index]
+        np.take(self._ohlcv, idx, axis=0, out=windows, mode='clip')
+        np.multiply(np.swapaxes(windows, -1, -2), self._inv_scale[:, None],
+                    out=obs[..., :5, :], casting='same_kind')
+
+        # Append additional data and scale each value to between 0-1
+        account = obs[..., 5, :]
+        account[..., 0] = self.balance[index]
+        account[..., 1] = self.max_net_worth[index]
+        account[..., 2] = self.shares_held[index]
+        account[..., 3] = self.cost_basis[index]
+        account[..., 4] = self.total_shares_sold[index]
+        account[..., 5] = self.total_sales_value[index]
+        account *= self._norm_account
+
+        # RLlib keeps references to returned observations, so hand out a copy
+        return obs.copy()
+
+    def _take_action(self, actions):
+        # Set the current price to a random price within the time step
+        o, c, price = self._open, self._close, self._price
+        tmp, value, traded, count = self._tmp, self._value, self._traded, self._count
+        np.take(self._ohlcv[:, 0], self.current_step, out=o, mode='clip')
+        np.take(self._ohlcv[:, 3], self.current_step, out=c, mode='clip')
+        # Take the spread in float64 so the price matches the scalar environment
+        np.subtract(c, o, out=tmp, dtype=np.float64)
+        self._rng.random(out=price)
+        price *= tmp
+        price += o
+
+        action_type = actions[:, 0]
+        amount = actions[:, 1]
+        buy, sell, mask = self._buy, self._sell, self._mask
+        np.less(action_type, 1, out=buy)
+        np.greater_equal(action_type, 1, out=sell)
+        sell &= np.less(action_type, 2, out=mask)
+
+        # Buy amount % of balance in shares
+        np.divide(self.balance, price, out=tmp)
+        np.trunc(tmp, out=tmp)
+        tmp *= buy
+        tmp *= amount
+        np.copyto(traded, tmp, casting='unsafe')
+        np.multiply(traded, price, out=value)
+
+        np.multiply(self.cost_basis, self.shares_held, out=tmp)
+        tmp += value
+        np.add(self.shares_held, traded, out=count)
+        np.maximum(count, 1, out=count)
+        tmp /= count
+
+        self.balance -= value
+        np.copyto(self.cost_basis, tmp, where=buy)
+        self.shares_held += traded
+
+        # Sell amount % of shares held
+        np.multiply(self.shares_held, amount, out=tmp)
+        tmp *= sell
+        np.copyto(traded, tmp, casting='unsafe')
+        np.multiply(traded, price, out=value)
+
+        self.balance += value
+        self.shares_held -= traded
+        self.total_shares_sold += traded
+        self.total_sales_value += value
+
+        np.multiply(self.shares_held, price, out=self.net_worth)
+        self.net_worth += self.balance
+        np.maximum(self.max_net_worth, self.net_worth, out=self.max_net_worth)
+        self.cost_basis *= np.not_equal(self.shares_held, 0, out=mask)
+
+    def vector_step(self, actions):
+        # Execute one time step within every sub-environment
+        self._take_action(np.asarray(actions, dtype=np.float64))
+
+        self.current_step += 1
+        np.copyto(self.current_step, 0,
+                  where=np.greater(self.current_step, self._max_start, out=self._mask))
+
+        rewards = np.multiply(self.current_step, self._inv_max_steps, out=self._rewards)
+        rewards *= self.balance
+
+        # End an episode on bankruptcy or when the data runs out
+        dones = np.less_equal(self.net_worth, 0, out=self._dones)
+        dones |= np.greater_equal(self.current_step, self._max_start, out=self._mask)
+
+        obs = self._next_observation(slice(None))
+
+        # The reward and done buffers are reused, so hand out copies as well
+        return obs, rewards.copy(), dones.copy(), [{} for _ in range(self.num_envs)]
+
+    def seed(self, seed=None):
+        # Re-seed the generator shared by all sub-environments
+        self._rng = np.random.default_rng(seed)
+
+        return [seed]
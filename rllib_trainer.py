@@ -2,15 +2,14 @@ import argparse
 import os
 import sys
 
-import pandas as pd
-
 import ray
 from ray.tune.registry import register_env
 from ray.rllib.agents import ppo
 from ray.rllib.models import ModelCatalog
 from ray import tune
 
-from env.StockTradingEnvironment import StockTradingEnvironment
+from env.StockTradingEnvironment import cache_ohlcv, load_ohlcv
+from env.VectorStockTradingEnvironment import VectorStockTradingEnvironment
 
 ###############################################
 ## Command line args
@@ -18,6 +17,7 @@ from env.StockTradingEnvironment import StockTradingEnvironment
 parser = argparse.ArgumentParser(description="Script for training RLLIB agents")
 parser.add_argument("--num-cpus", type=int, default=1)
 parser.add_argument("--num-gpus", type=int, default=0)
+parser.add_argument("--num-envs-per-worker", type=int, default=1)
 parser.add_argument("--tune-log-level", type=str, default="INFO")
 parser.add_argument("--env-logging", action="store_true")
 parser.add_argument("--redis-password", type=str, default=None)
@@ -39,8 +39,18 @@ else:
 #############################################
 ## LOAD AND CONFIGURE YOUR PROBLEM INSTANCE 
 #############################################
+if args.redis_password is None:
+    # Single machine: workers only receive the path and memory-map the cached
+    # .npy copy of the CSV, so no DataFrame is pickled to them. Build the cache
+    # up front so workers don't race to create it.
+    data = cache_ohlcv(os.path.abspath("data/AAPL.csv"))
+else:
+    # Cluster: workers on other nodes may have no checkout (or a read-only
+    # one), so ship the price array through the object store instead
+    data = ray.put(load_ohlcv("data/AAPL.csv"))
+
 env_config = {
-    "df": pd.read_csv("data/AAPL.csv", index_col=[0]),
+    "data": data,
     "MAX_ACCOUNT_BALANCE": 2147483647,
     "MAX_NUM_SHARES": 2147483647,
     "MAX_SHARE_PRICE": 5000,
@@ -51,7 +61,8 @@ env_config = {
 print("env_config: ", env_config)
 
 env_name = "StockTrading_env"
-register_env(env_name, lambda config: StockTradingEnvironment(**env_config))
+register_env(env_name, lambda config: VectorStockTradingEnvironment(
+    num_envs=args.num_envs_per_worker, **env_config))
 
 
 
@@ -71,6 +82,7 @@ tune.run(
         "env": env_name,
         "num_workers": args.num_cpus, 
         "num_gpus": args.num_gpus,
+        "num_envs_per_worker": args.num_envs_per_worker,
         "log_level": args.tune_log_level,
         "train_batch_size": 4000,
         "ignore_worker_failures": True,
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from env.StockTradingEnvironment import StockTradingEnvironment, _apply
+
+
+def test_batch_step_matches_step():
+    # batch_step runs the same kernel as step, so a trajectory must match
+    batched = StockTradingEnvironment(steps_per_call=200)
+    single = StockTradingEnvironment()
+    for env in (batched, single):
+        env.seed(0)
+        env.reset()
+        env.seed(1)
+
+    actions = np.random.default_rng(2).random((200, 2)) * [3, 1]
+    obs, rewards, dones, infos = batched.batch_step(actions)
+    for i in range(len(rewards)):
+        o, r, d, _ = single.step(actions[i])
+        assert np.array_equal(o, obs[i])
+        assert r == rewards[i] and d == dones[i]
+
+
+def test_vector_take_action_matches_apply():
+    # The account update exists twice: the numba kernel behind the scalar env
+    # and the array version in the vector env. Keep the two from drifting.
+    pytest.importorskip('ray.rllib')
+    from env.VectorStockTradingEnvironment import VectorStockTradingEnvironment
+
+    n = 10000
+    env = VectorStockTradingEnvironment(num_envs=n)
+    rng = np.random.default_rng(0)
+    env.balance[:] = rng.random(n) * 20000
+    env.shares_held[:] = rng.integers(0, 50, n) * rng.integers(0, 2, n)
+    env.cost_basis[:] = rng.random(n) * 100 * (env.shares_held != 0)
+    env.max_net_worth[:] = env.balance + rng.random(n) * 5000
+    env.total_shares_sold[:] = rng.integers(0, 1000, n)
+    env.total_sales_value[:] = rng.random(n) * 50000
+    env.current_step[:] = rng.integers(0, env._max_start, n)
+    actions = rng.random((n, 2)) * [3, 1]
+
+    # Reproduce the prices the vector env samples from its generator
+    o = env._ohlcv[env.current_step, 0].astype(np.float64)
+    c = env._ohlcv[env.current_step, 3].astype(np.float64)
+    price = o + np.random.default_rng(1).random(n) * (c - o)
+    expected = [
+        _apply(actions[i, 0], actions[i, 1], price[i],
+               env.balance[i], int(env.shares_held[i]), env.cost_basis[i],
+               env.max_net_worth[i], int(env.total_shares_sold[i]), env.total_sales_value[i])
+        for i in range(n)]
+
+    env._rng = np.random.default_rng(1)
+    env._take_action(actions)
+
+    fields = (env.balance, env.shares_held, env.cost_basis, env.net_worth,
+              env.max_net_worth, env.total_shares_sold, env.total_sales_value)
+    for field, values in zip(fields, zip(*expected)):
+        np.testing.assert_array_equal(field, values)